@@ -14,10 +14,11 @@ Usage:
 
 import sqlite3
 import pandas as pd
-import ast
+import json
 import numpy as np
 import os
 import logging
+from urllib.request import pathname2url
 
 
 #PATHS - use project-relative directories
@@ -59,6 +60,45 @@ logger = logging.getLogger(__name__)
 
 #DATA CLEANSING FUNCTIONS
 
+def _date_key(dates):
+
+    """
+    Encode datetime64[D] values as YYYYMMDD integers.
+    Differences of two keys floor-divided by 10000 give whole years.
+    """
+
+    years = dates.astype('datetime64[Y]')
+    months = dates.astype('datetime64[M]')
+
+    year = years.astype(np.int64) + 1970
+    month = (months - years).astype(np.int64) + 1
+    day = (dates - months).astype(np.int64) + 1
+
+    return year * 10000 + month * 100 + day
+
+
+def _age_and_group(dob, today):
+
+    """
+    Compute ages and 10 year age groups from datetime64[D] birth dates.
+    Invalid (NaT) birth dates give NaN so they are caught by test_nulls.
+
+    Returns:
+        tuple: (age, age_group) int64 arrays, float64 if any dob is NaT
+    """
+
+    age = (_date_key(today) - _date_key(dob)) // 10000
+    age_group = age - age % 10
+
+    #NaT casts to the minimum int64, so mask those rows back to NaN
+    invalid = np.isnat(dob)
+    if invalid.any():
+        age = np.where(invalid, np.nan, age)
+        age_group = np.where(invalid, np.nan, age_group)
+
+    return (age, age_group)
+
+
 def cleanse_student_table(df):
 
     """
@@ -69,55 +109,56 @@ def cleanse_student_table(df):
         tuple: (cleaned_df, nulls_df)
     """
 
-    today = pd.to_datetime('today')
+    today = np.datetime64(pd.to_datetime('today').date(), 'D')
 
     df['dob'] = pd.to_datetime(df['dob'], errors='coerce') #convert to datetime
 
-    df['age'] = (
-        today.year 
-        - df['dob'].dt.year 
-        - (
-            (today.month < df['dob'].dt.month) | 
-            ((today.month == df['dob'].dt.month) & 
-             (today.day < df['dob'].dt.day))
-        )
-    )
-
-    #bucket into age groups of 10 years
-    df['age_group'] = np.int64((df['age']/10))*10
+    #age in whole years and 10 year age groups, from the raw datetime64 buffer
+    dob = df['dob'].to_numpy().astype('datetime64[D]')
+    df['age'], df['age_group'] = _age_and_group(dob, today)
 
-    #json normalize to explode into dictionary
-    df['contact_info'] = df['contact_info'].apply(lambda x: ast.literal_eval(x))
-    explode_contact = pd.json_normalize(df['contact_info'])
+    #parse JSON contact info and explode it into one column per key
+    records = [json.loads(x) for x in df['contact_info'].to_numpy()]
+    keys = records[0].keys() if records else []
+    explode_contact = pd.DataFrame({k: [r.get(k) for r in records] for k in keys})
     df = pd.concat([df.drop('contact_info', axis=1).reset_index(drop=True), explode_contact], axis=1)
 
     #split mailing address
-    split_add = df.mailing_address.str.split(',', expand=True)
-    split_add.columns = ['street', 'city', 'state', 'zip_code']
+    split_add = pd.DataFrame(
+        [x.split(',', 3) for x in df['mailing_address'].to_numpy()],
+        columns=['street', 'city', 'state', 'zip_code'],
+        index=df.index
+    )
     df = pd.concat([df.drop('mailing_address', axis=1), split_add], axis=1)
 
     #convert object datatypes to float where needed
-    df['job_id'] = df['job_id'].astype(float)
-    df['current_career_path_id'] = df['current_career_path_id'].astype(float)
-    df['num_course_taken'] = df['num_course_taken'].astype(float)
-    df['time_spent_hrs'] = df['time_spent_hrs'].astype(float)
+    df = df.astype({
+        'job_id': float,
+        'current_career_path_id': float,
+        'num_course_taken': float,
+        'time_spent_hrs': float
+    })
 
-    #collect null rows for reporting
-    null_data = pd.DataFrame()
+    #collect null rows for reporting, concatenated once at the end
+    null_frames = []
 
     #drop rows with null num_course_taken
-    null_course_taken = df[df[['num_course_taken']].isnull().any(axis=1)]
-    null_data = pd.concat([null_data, null_course_taken])
-    df = df.dropna(subset=['num_course_taken'])
+    null_course_taken = df['num_course_taken'].isna().to_numpy()
+    null_frames.append(df[null_course_taken])
+    df = df[~null_course_taken]
 
     #drop rows with null job_id
-    null_job_id = df[df[['job_id']].isnull().any(axis=1)]
-    null_data = pd.concat([null_data, null_job_id])
-    df = df.dropna(subset=['job_id'])
+    null_job_id = df['job_id'].isna().to_numpy()
+    null_frames.append(df[null_job_id])
+    df = df[~null_job_id]
+
+    null_data = pd.concat(null_frames)
 
     #replace remaining nulls in career_path_id / time_spent
-    df['current_career_path_id'] = np.where(df['current_career_path_id'].isnull(), 0, df['current_career_path_id'])
-    df['time_spent_hrs'] = np.where(df['time_spent_hrs'].isnull(), 0, df['time_spent_hrs'])
+    df = df.fillna({'current_career_path_id': 0, 'time_spent_hrs': 0})
+
+    #consolidate into contiguous blocks once before the downstream joins
+    df = df.copy()
 
     return (df, null_data)
 
@@ -129,20 +170,24 @@ def cleanse_career_path(df):
     """
 
     #add new career path id to account for students not taking a career path
-    not_applicable = {'career_path_id': 0, 'career_path_name': 'not_applicable', 'hours_to_complete': 0}
-
-    df.loc[len(df)] = not_applicable
+    not_applicable = pd.DataFrame([{'career_path_id': 0, 'career_path_name': 'not_applicable', 'hours_to_complete': 0}])
 
-    return(df)
+    return(pd.concat([df, not_applicable], ignore_index=True))
 
-def cleanse_student_jobs(df):
+def join_lookup(df, lookup, left_on, right_on=None):
 
     """
-    Remove duplicates from the student jobs table.
+    Left join a small lookup table keyed by unique ids onto df.
+    Equivalent to df.merge(lookup, how='left') for a unique right key,
+    but aligns rows with a single index lookup instead of a hash join.
     """
 
-    return(df.drop_duplicates())
+    right_on = right_on or left_on
 
+    matched = lookup.set_index(right_on, drop=(right_on == left_on)).reindex(df[left_on].to_numpy())
+    matched.index = df.index
+
+    return pd.concat([df, matched], axis=1)
 
 
 #UNIT TESTS
@@ -173,15 +218,10 @@ def test_schema(local_df: pd.DataFrame, db_df: pd.DataFrame):
     Check that schemas match between local and DB versions.
     """
 
-    errors = 0
-    for col in db_df:
-        try:
-            if local_df[col].dtypes != db_df[col].dtypes:
-                errors += 1
-        except NameError as ne:
-            logger.exception(ne)
-            raise ne
-    
+    #compare all column dtypes at once; columns missing locally count as mismatches
+    mismatch = local_df.dtypes.reindex(db_df.columns) != db_df.dtypes
+    errors = int(mismatch.sum())
+
     if errors > 0:
         assert_error_msg = str(errors) + "Column(s) dtypes aren't the same"
         logger.exception(assert_error_msg)
@@ -211,9 +251,8 @@ def test_for_path_id(students: pd.DataFrame, career_paths: pd.DataFrame):
     Check career_path_id referential integrity.
     """
 
-    student_table = students.current_career_path_id.unique()
-    is_subset = np.isin(student_table, career_paths.career_path_id.unique())
-    missing_id = student_table[~is_subset]
+    #difference de-duplicates the student ids itself; the reference ids are a key
+    missing_id = pd.Index(students.current_career_path_id).difference(pd.Index(career_paths.career_path_id)).to_numpy()
 
     try:
         assert len(missing_id) == 0, "Missing career_path_id(s): " + str(list(missing_id)) + " in `career_paths` table"
@@ -229,9 +268,8 @@ def test_for_job_id(students: pd.DataFrame, student_jobs: pd.DataFrame):
     Check job_id referential integrity.
     """
 
-    student_table = students.job_id.unique()
-    is_subset = np.isin(student_table, student_jobs.job_id.unique())
-    missing_id = student_table[~is_subset]
+    #difference de-duplicates the student ids itself; the reference ids are a key
+    missing_id = pd.Index(students.job_id).difference(pd.Index(student_jobs.job_id)).to_numpy()
 
     try:
         assert len(missing_id) == 0, "Missing job_id(s): " + str(list(missing_id)) + " in `student_jobs` table"
@@ -244,6 +282,78 @@ def test_for_job_id(students: pd.DataFrame, student_jobs: pd.DataFrame):
         print("All job_ids are present")
 
 
+#DATABASE HELPERS
+
+def connect_cleansed_db():
+
+    """
+    Open the cleansed database with per-connection PRAGMAs tuned for bulk appends.
+    The journal mode is left alone since it is persisted in the database file.
+    """
+
+    con = sqlite3.connect(CLEANSED_DB_PATH)
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute("PRAGMA cache_size=-200000")
+
+    return con
+
+
+def append_rows(con, table, df):
+
+    """
+    Append df to table with a single parameter-bound executemany.
+    Creates the table from df's schema if it does not exist yet.
+    Expects df to contain no nulls.
+    """
+
+    #let pandas create the table with its usual column types on first run
+    df.head(0).to_sql(table, con, if_exists='append', index=False)
+
+    #store datetimes as the same text pandas writes to sqlite
+    datetime_cols = df.select_dtypes(include='datetime').columns
+    df = df.assign(**{col: df[col].dt.strftime('%Y-%m-%d %H:%M:%S') for col in datetime_cols})
+
+    columns = ', '.join(f'"{col}"' for col in df.columns)
+    placeholders = ', '.join('?' * len(df.columns))
+
+    con.executemany(
+        f'INSERT INTO "{table}" ({columns}) VALUES ({placeholders})',
+        df.itertuples(index=False, name=None)
+    )
+
+
+def write_cleansed_csv(df_clean, clean_count):
+
+    """
+    Keep the cleansed csv in step with cademycode_aggregated.
+    Appends only the new rows when the table already had clean_count rows,
+    and regenerates the whole csv from the table if it has gone missing.
+    """
+
+    if clean_count == 0:
+        #the table was just created, so df_clean is all of it
+        df_clean.to_csv(CLEANSED_CSV_PATH, index=False, date_format='%Y-%m-%d %H:%M:%S')
+
+    elif os.path.exists(CLEANSED_CSV_PATH):
+        df_clean.to_csv(
+            CLEANSED_CSV_PATH,
+            mode='a',
+            header=False,
+            index=False,
+            date_format='%Y-%m-%d %H:%M:%S'
+        )
+
+    else:
+        logger.warning("%s is missing; regenerating it from cademycode_aggregated", CLEANSED_CSV_PATH)
+        con = sqlite3.connect(CLEANSED_DB_PATH)
+        try:
+            clean_db = pd.read_sql_query("SELECT * FROM cademycode_aggregated", con)
+        finally:
+            con.close()
+        clean_db.to_csv(CLEANSED_CSV_PATH, index=False)
+
+
 #MAIN PIPELINE LOGIC
 
 def main():
@@ -269,68 +379,92 @@ def main():
             next_ver = 0
 
 
-    con = sqlite3.connect(RAW_DB_PATH)
-    students = pd.read_sql_query("SELECT * FROM cademycode_students", con)
+    #the raw database is never written; open it read-only and immutable
+    con = sqlite3.connect(f"file:{pathname2url(RAW_DB_PATH)}?mode=ro&immutable=1", uri=True)
     career_paths = pd.read_sql_query("SELECT * FROM cademycode_courses", con)
-    student_jobs = pd.read_sql_query("SELECT * FROM cademycode_student_jobs", con)
-    con.close()
+    #duplicates are removed by sqlite while reading
+    student_jobs = pd.read_sql_query("SELECT DISTINCT * FROM cademycode_student_jobs", con)
+
+    #only a sample row (for schema checks), the row count and the recorded
+    #incomplete uuids are needed from the cleansed tables
+    clean_con = sqlite3.connect(CLEANSED_DB_PATH)
 
     try:
-        con = sqlite3.connect(CLEANSED_DB_PATH)
-        clean_db = pd.read_sql_query("SELECT * FROM cademycode_aggregated", con)
-        missing_db = pd.read_sql_query("SELECT * FROM incomplete_data", con)
-        con.close()
-        
-        new_students = students[~np.isin(students.uuid.unique(), clean_db.uuid.unique())]
+        clean_db = pd.read_sql_query("SELECT * FROM cademycode_aggregated LIMIT 1", clean_con)
+        clean_count = clean_con.execute("SELECT COUNT(*) FROM cademycode_aggregated").fetchone()[0]
+    except pd.errors.DatabaseError:
+        #first run: the aggregated table does not exist yet
+        clean_db = pd.DataFrame()
+        clean_count = 0
 
-    except:
-        new_students = students
-        clean_db = []
+    try:
+        missing_db = pd.read_sql_query("SELECT uuid FROM incomplete_data", clean_con)
+    except pd.errors.DatabaseError:
+        missing_db = pd.DataFrame(columns=['uuid'])
+
+    clean_con.close()
+
+    if clean_count > 0:
+        #anti-join in SQL so only students not yet cleansed are loaded;
+        #the cleansed database is attached read-only for this query
+        con.execute("ATTACH DATABASE ? AS cleansed", (f"file:{pathname2url(CLEANSED_DB_PATH)}?mode=ro",))
+        new_students = pd.read_sql_query(
+            """
+            SELECT * FROM cademycode_students
+            WHERE uuid NOT IN (SELECT uuid FROM cleansed.cademycode_aggregated)
+            """,
+            con
+        )
+    else:
+        new_students = pd.read_sql_query("SELECT * FROM cademycode_students", con)
+
+    con.close()
 
     clean_new_students, missing_data = cleanse_student_table(new_students)
 
-    try:
-        new_missing_data = missing_data[~np.isin(missing_data.uuid.unique(), missing_db.uuid.unique())]
-    except:
-        new_missing_data = missing_data
+    new_missing_data = missing_data[~missing_data['uuid'].isin(missing_db['uuid'].to_numpy())]
 
     if len(new_missing_data) > 0:
-        sqlite_connection = sqlite3.connect(CLEANSED_DB_PATH)
-        new_missing_data.to_sql('incomplete_data', sqlite_connection, if_exists='append', index=False)
-        sqlite_connection.close()
+        sqlite_connection = connect_cleansed_db()
+        try:
+            new_missing_data.to_sql('incomplete_data', sqlite_connection, if_exists='append', index=False)
+        finally:
+            sqlite_connection.close()
 
     if len(clean_new_students) > 0:
         clean_career_paths = cleanse_career_path(career_paths)
-        clean_student_jobs = cleanse_student_jobs(student_jobs)
 
-        test_for_job_id(clean_new_students, clean_student_jobs)
+        test_for_job_id(clean_new_students, student_jobs)
         test_for_path_id(clean_new_students, clean_career_paths)
 
-        df_clean = clean_new_students.merge(
+        df_clean = join_lookup(
+            clean_new_students,
             clean_career_paths,
             left_on='current_career_path_id',
-            right_on='career_path_id',
-            how='left'
+            right_on='career_path_id'
         )
 
-        df_clean = df_clean.merge(
-            clean_student_jobs,
-            on='job_id',
-            how='left'
+        df_clean = join_lookup(
+            df_clean,
+            student_jobs,
+            left_on='job_id'
         )
 
-        if len(clean_db) > 0:
+        if clean_count > 0:
             test_num_cols(df_clean, clean_db)
             test_schema(df_clean, clean_db)
         
         test_nulls(df_clean)
 
-        sqlite_connection = sqlite3.connect(CLEANSED_DB_PATH)
-        df_clean.to_sql('cademycode_aggregated', sqlite_connection, if_exists='append', index=False)
-        clean_db = pd.read_sql_query("SELECT * FROM cademycode_aggregated", sqlite_connection)
-        sqlite_connection.close()
+        sqlite_connection = connect_cleansed_db()
+        try:
+            #commit the executemany insert as one transaction
+            with sqlite_connection:
+                append_rows(sqlite_connection, 'cademycode_aggregated', df_clean)
+        finally:
+            sqlite_connection.close()
 
-        clean_db.to_csv(CLEANSED_CSV_PATH)
+        write_cleansed_csv(df_clean, clean_count)
 
         new_lines = [
             f"## 0.0.{next_ver}\n",